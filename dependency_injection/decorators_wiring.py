@@ -1,6 +1,7 @@
-import other_file
 from provider import Provider, provider
 
+provider.register_lazy("injected_g", "other_file:injected_g")  # other_file is imported on first use
+
 
 @provider.register(key="injected_f")
 def injected_f():
@@ -1,30 +1,205 @@
+import asyncio
 import functools
+import importlib
+import inspect
+import json
+import threading
+import typing
+from enum import Enum
+
+
+class Lifetime(Enum):
+    TRANSIENT = "transient"  # new instance on every resolve
+    SINGLETON = "singleton"  # one instance per provider
+    SCOPED = "scoped"  # one instance per provider.scope()
+
+
+_MISSING = object()
+
+
+class ResolutionError(KeyError):
+    """Missing registration or dependency cycle"""
+
+
+def _dependencies(resource, resources, lazy=()):
+    """(parameter name, key) pairs to inject, from the type hints of the constructor/factory
+
+    Hints registered lazily count as known, they are imported when the plan is compiled.
+    """
+    target = resource.__init__ if inspect.isclass(resource) else resource
+    try:
+        hints = typing.get_type_hints(target)
+    except (NameError, TypeError):
+        hints = getattr(target, "__annotations__", {})
+    try:
+        parameters = inspect.signature(resource).parameters
+    except (ValueError, TypeError):  # builtins like dict may have no signature, nothing to inject
+        return ()
+    dependencies = []
+    for name, parameter in parameters.items():
+        if parameter.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD):
+            continue
+        hint = hints.get(name, _MISSING)
+        if hint is not _MISSING and (hint in resources or hint in lazy):
+            dependencies.append((name, hint))
+        elif parameter.default is inspect.Parameter.empty:
+            raise ResolutionError(f"{resource} needs '{name}' ({hint if hint is not _MISSING else 'no hint'}), "
+                                  f"which is not registered")
+    return tuple(dependencies)
+
+
+async def _create_once(instances, pending, key, create):
+    """Awaits the single in-flight creation of `key`, started by whichever coroutine asked first"""
+    instance = instances.get(key, _MISSING)
+    if instance is not _MISSING:
+        return instance
+    task = pending.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_store(instances, pending, key, create))
+        pending[key] = task
+    return await asyncio.shield(task)  # a cancelled caller doesn't cancel the shared creation
+
+
+async def _store(instances, pending, key, create):
+    try:
+        instance = await create()
+        instances[key] = instance
+        return instance
+    finally:
+        pending.pop(key, None)
+
+
+class Scope:
+    def __init__(self, provider) -> None:
+        self.provider = provider
+        self.instances = {}
+        self.pending = {}
+        self.lock = threading.RLock()
+
+    def resolve(self, key):
+        return self.provider.resolve(key, scope=self)
+
+    async def aget(self, key):
+        return await self.provider.aget(key, scope=self)
+
+    def _get_or_create(self, key, factory):
+        instance = self.instances.get(key, _MISSING)
+        if instance is _MISSING:
+            with self.lock:
+                instance = self.instances.get(key, _MISSING)
+                if instance is _MISSING:
+                    instance = factory()
+                    self.instances[key] = instance
+        return instance
+
+    def close(self):
+        """Closes scoped instances, most recently created first"""
+        with self.lock:
+            instances, self.instances = list(self.instances.values()), {}
+        for instance in reversed(instances):
+            close = getattr(instance, "close", None)
+            if callable(close):
+                close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def aclose(self):
+        """Like close, awaiting async close() methods"""
+        with self.lock:
+            instances, self.instances = list(self.instances.values()), {}
+        for instance in reversed(instances):
+            close = getattr(instance, "aclose", None) or getattr(instance, "close", None)
+            if callable(close):
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
 
 
 class Provider:
     class _Singelton:
         def __init__(self) -> None:
             self.resources = {}
+            self.lifetimes = {}
+            self.instances = {}
+            self.pending = {}
+            self.locks = {}
+            self.plans = {}
+            self.lazy = {}
+            self.loading = {}  # lazy key -> id of the thread importing it
+            self.lock = threading.Lock()
 
-        def register(self, resource_key, resource):
+        def register(self, resource_key, resource, lifetime=Lifetime.TRANSIENT):
             print(f"Registered {resource} as {resource_key}")
 
             if resource_key in self.resources:
                 raise KeyError(f"{resource_key} already registered")
+            if resource_key in self.lazy and self.loading.get(resource_key) != threading.get_ident():
+                raise KeyError(f"{resource_key} already registered lazily")  # only its own import may register it
             self.resources[resource_key] = resource
+            self.lifetimes[resource_key] = lifetime
             return resource
 
+        def register_lazy(self, resource_key, target, lifetime=Lifetime.TRANSIENT):
+            if resource_key in self.resources or resource_key in self.lazy:
+                raise KeyError(f"{resource_key} already registered")
+            self.lazy[resource_key] = (target, lifetime)
+
+        def load(self, resource_key):
+            """Imports a lazy entry on first use, returns True if the key is (now) registered"""
+            if resource_key in self.resources:
+                return True
+            if resource_key not in self.lazy:
+                # a concurrent load may have registered and popped it since the first check
+                return resource_key in self.resources
+            with self.key_lock(resource_key):  # one import per key, even under contention
+                if resource_key not in self.resources:
+                    target, lifetime = self.lazy[resource_key]
+                    module_name, _, attr = target.partition(":")
+                    self.loading[resource_key] = threading.get_ident()
+                    try:
+                        resource = getattr(importlib.import_module(module_name), attr)
+                        if resource_key not in self.resources:  # the import may have registered it already
+                            self.register(resource_key, resource, lifetime)
+                    finally:
+                        del self.loading[resource_key]
+                self.lazy.pop(resource_key, None)
+            return True
+
+        def get_or_create(self, resource_key, factory):
+            instance = self.instances.get(resource_key, _MISSING)
+            if instance is _MISSING:  # double-checked, the factory runs once even under contention
+                with self.key_lock(resource_key):
+                    instance = self.instances.get(resource_key, _MISSING)
+                    if instance is _MISSING:
+                        instance = factory()
+                        self.instances[resource_key] = instance
+            return instance
+
+        def key_lock(self, resource_key):
+            with self.lock:
+                return self.locks.setdefault(resource_key, threading.RLock())
+
     instance = None
 
     def __init__(self) -> None:
         if not Provider.instance:
             Provider.instance = Provider._Singelton()
 
-    def register(self, resource=None, *, key=None):
+    def register(self, resource=None, *, key=None, lifetime=Lifetime.TRANSIENT):
         @functools.wraps(resource)
         def register_decorator(resource):
             resource_key = resource if key is None else key
-            Provider.instance.register(resource_key, resource)
+            Provider.instance.register(resource_key, resource, lifetime)
             return resource
 
         if resource is None:  # decorator called with arguments
@@ -32,8 +207,136 @@ class Provider:
 
         return register_decorator(resource)
 
+    def register_lazy(self, key, target, lifetime=Lifetime.TRANSIENT):
+        """Registers `key` as a "module:attr" entry point, the module is imported on first get/resolve"""
+        Provider.instance.register_lazy(key, target, lifetime)
+
+    def register_manifest(self, manifest):
+        """Lazy entries from a {key: "module:attr" | {"target": ..., "lifetime": ...}} dict or json file path"""
+        if isinstance(manifest, str):
+            with open(manifest) as file:
+                manifest = json.load(file)
+        for key, entry in manifest.items():
+            if isinstance(entry, str):
+                entry = {"target": entry}
+            self.register_lazy(key, entry["target"], Lifetime(entry.get("lifetime", Lifetime.TRANSIENT.value)))
+
     def get(self, key):
-        return Provider.instance.resources.get(key, None)
+        registry = Provider.instance
+        if key not in registry.resources and key in registry.lazy:
+            registry.load(key)
+        return registry.resources.get(key, None)
+
+    def freeze(self):
+        """Compiles resolver plans for all registered keys, failing early on cycles and missing keys"""
+        for key in list(Provider.instance.resources):
+            self._compile(key)
+        return self
+
+    def _compile(self, key, visiting=()):
+        """Flat plan of a key: (factory, lifetime, (parameter name, dependency key) pairs, is async)"""
+        registry = Provider.instance
+        plan = registry.plans.get(key)
+        if plan is not None:
+            return plan
+        if key in visiting:
+            cycle = visiting[visiting.index(key):] + (key,)
+            raise ResolutionError(f"Dependency cycle: {' -> '.join(map(str, cycle))}")
+        if not registry.load(key):
+            raise ResolutionError(f"{key} is not registered" + (f", required by {visiting[-1]}" if visiting else ""))
+        resource = registry.resources[key]
+        dependencies = _dependencies(resource, registry.resources, registry.lazy)
+        for _, dependency in dependencies:
+            self._compile(dependency, visiting + (key,))
+        plan = (resource, registry.lifetimes[key], dependencies, inspect.iscoroutinefunction(resource))
+        if plan[1] is Lifetime.SINGLETON:
+            scoped = self._scoped_dependency(plan)
+            if scoped is not None:
+                raise ResolutionError(f"Singleton {key} depends on scoped {scoped}, "
+                                      f"which would outlive its scope")
+        registry.plans[key] = plan
+        return plan
+
+    def _scoped_dependency(self, plan):
+        """First scoped key the plan's instances capture, directly or through transient dependencies"""
+        for _, dependency in plan[2]:
+            dependency_plan = Provider.instance.plans[dependency]
+            if dependency_plan[1] is Lifetime.SCOPED:
+                return dependency
+            if dependency_plan[1] is Lifetime.TRANSIENT:
+                scoped = self._scoped_dependency(dependency_plan)
+                if scoped is not None:
+                    return scoped
+        return None
+
+    def resolve(self, key, scope=None):
+        """Returns an instance of `key` according to its registered lifetime, injecting its dependencies"""
+        registry = Provider.instance
+        plan = registry.plans.get(key) or self._compile(key)
+        factory, lifetime, dependencies, is_async = plan
+        if is_async:
+            instance = registry.instances.get(key, _MISSING)
+            if lifetime is Lifetime.SINGLETON and instance is not _MISSING:
+                return instance  # already created by aget/warm_up
+            raise TypeError(f"{key} has an async factory, use `await provider.aget({key!r})`")
+        if dependencies:
+            factory = functools.partial(self._create, plan, scope)
+        if lifetime is Lifetime.TRANSIENT:
+            return factory()
+        if lifetime is Lifetime.SCOPED:
+            if scope is None:
+                raise RuntimeError(f"{key} is scoped, resolve it within provider.scope()")
+            return scope._get_or_create(key, factory)
+        return registry.get_or_create(key, factory)
+
+    def _create(self, plan, scope):
+        factory, _, dependencies, _ = plan
+        return factory(**{name: self.resolve(dependency, scope) for name, dependency in dependencies})
+
+    async def aget(self, key, scope=None):
+        """Async resolve: awaits async factories, dependencies are resolved concurrently
+
+        Async singletons (and scoped instances) are created exactly once, concurrent callers share the creation.
+        """
+        registry = Provider.instance
+        plan = registry.plans.get(key) or self._compile(key)
+        lifetime = plan[1]
+        create = functools.partial(self._acreate, key, plan, scope)
+        if lifetime is Lifetime.TRANSIENT:
+            return await create()
+        if lifetime is Lifetime.SCOPED:
+            if scope is None:
+                raise RuntimeError(f"{key} is scoped, resolve it within provider.scope()")
+            return await _create_once(scope.instances, scope.pending, key, create)
+        return await _create_once(registry.instances, registry.pending, key, create)
+
+    async def _acreate(self, key, plan, scope):
+        factory, lifetime, dependencies, is_async = plan
+        values = await asyncio.gather(*(self.aget(dependency, scope) for _, dependency in dependencies))
+        create = functools.partial(factory, **{name: value for (name, _), value in zip(dependencies, values)})
+        # sync factories go through resolve's locks, so a thread resolving the same key doesn't create it again
+        if is_async or lifetime is Lifetime.TRANSIENT:
+            instance = create()
+        elif lifetime is Lifetime.SCOPED:
+            instance = scope._get_or_create(key, create)
+        else:
+            instance = Provider.instance.get_or_create(key, create)
+        # also awaits sync callables returning awaitables, e.g. lambdas or classes with an async __call__
+        return await instance if is_async or inspect.isawaitable(instance) else instance
+
+    async def warm_up(self):
+        """Creates all singletons, independent ones concurrently, each after its dependencies
+
+        Only singletons and their dependencies are compiled, other keys may need arguments at call time.
+        """
+        registry = Provider.instance
+        singletons = [key for key in list(registry.resources) if registry.lifetimes[key] is Lifetime.SINGLETON]
+        for key in singletons:
+            self._compile(key)
+        await asyncio.gather(*(self.aget(key) for key in singletons))
+
+    def scope(self):
+        return Scope(self)
 
     def __getattr__(self, name):
         return getattr(self.instance, name)
@@ -1,5 +1,9 @@
+import asyncio
+import sys
+import threading
+import time
 import pytest
-from provider import Provider, provider
+from provider import Lifetime, Provider, ResolutionError, provider
 
 
 class TestClass:
@@ -68,3 +72,322 @@ def test__decorated_class__get_key(lookup_key, expected_class):
     instance = provider.get(lookup_key)()
 
     assert isinstance(instance, expected_class)
+
+
+class Closable:
+    def __init__(self) -> None:
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test__resolve_transient__new_instance_each_time():
+    provider.register(Closable, key='transient', lifetime=Lifetime.TRANSIENT)
+
+    assert provider.resolve('transient') is not provider.resolve('transient')
+
+
+def test__resolve_singleton__same_instance():
+    provider.register(Closable, key='singleton', lifetime=Lifetime.SINGLETON)
+
+    assert provider.resolve('singleton') is provider.resolve('singleton')
+
+
+def test__resolve_singleton_concurrently__created_once():
+    created = []
+
+    def slow_factory():
+        time.sleep(0.05)
+        created.append(1)
+        return object()
+
+    provider.register(slow_factory, key='slow_singleton', lifetime=Lifetime.SINGLETON)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(provider.resolve('slow_singleton')))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test__resolve_scoped__same_within_scope_closed_on_exit():
+    provider.register(Closable, key='scoped', lifetime=Lifetime.SCOPED)
+
+    with provider.scope() as scope1:
+        first = scope1.resolve('scoped')
+        assert scope1.resolve('scoped') is first
+    with provider.scope() as scope2:
+        second = scope2.resolve('scoped')
+
+    assert first is not second
+    assert first.closed and second.closed
+
+
+def test__resolve_scoped_outside_scope__exception_thrown():
+    provider.register(Closable, key='scoped_outside', lifetime=Lifetime.SCOPED)
+
+    with pytest.raises(RuntimeError):
+        provider.resolve('scoped_outside')
+
+
+def test__resolve_unknown__exception_thrown():
+    with pytest.raises(KeyError):
+        provider.resolve('not_here')
+
+
+@pytest.fixture
+def fresh_provider(monkeypatch):
+    monkeypatch.setattr(Provider, "instance", Provider._Singelton())
+    return Provider()
+
+
+class Config:
+    pass
+
+
+class Client:
+    def __init__(self, config: Config) -> None:
+        self.config = config
+
+
+class Service:
+    def __init__(self, client: Client, retries: int = 3) -> None:
+        self.client = client
+        self.retries = retries
+
+
+def test__resolve__dependencies_injected_by_type_hints(fresh_provider):
+    fresh_provider.register(Config, lifetime=Lifetime.SINGLETON)
+    fresh_provider.register(Client)
+    fresh_provider.register(Service)
+
+    service = fresh_provider.freeze().resolve(Service)
+
+    assert isinstance(service.client, Client)
+    assert service.client.config is fresh_provider.resolve(Config)
+    assert service.retries == 3
+
+
+def test__freeze_missing_dependency__exception_thrown(fresh_provider):
+    fresh_provider.register(Service)
+
+    with pytest.raises(ResolutionError):
+        fresh_provider.freeze()
+
+
+def test__freeze_singleton_on_scoped__exception_thrown(fresh_provider):
+    fresh_provider.register(Config, lifetime=Lifetime.SCOPED)
+    fresh_provider.register(Client)
+    fresh_provider.register(Service, lifetime=Lifetime.SINGLETON)
+
+    with pytest.raises(ResolutionError, match="scoped"):
+        fresh_provider.freeze()
+
+
+def test__resolve_builtin__created_without_dependencies(fresh_provider):
+    fresh_provider.register(dict, key="d")
+
+    assert fresh_provider.resolve("d") == {}
+
+
+class CycleA:
+    def __init__(self, b: "CycleB") -> None:
+        pass
+
+
+class CycleB:
+    def __init__(self, a: CycleA) -> None:
+        pass
+
+
+def test__freeze_cycle__exception_thrown(fresh_provider):
+    fresh_provider.register(CycleA)
+    fresh_provider.register(CycleB)
+
+    with pytest.raises(ResolutionError, match="cycle"):
+        fresh_provider.freeze()
+
+
+@pytest.fixture
+def lazy_module(tmp_path, monkeypatch):
+    (tmp_path / "lazy_resources.py").write_text(
+        "import time\n"
+        "imports = [1]\n"
+        "time.sleep(0.05)\n"
+        "class LazyResource:\n"
+        "    pass\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield "lazy_resources"
+    sys.modules.pop("lazy_resources", None)
+
+
+def test__register_lazy__imported_on_first_get(fresh_provider, lazy_module):
+    fresh_provider.register_lazy("lazy", f"{lazy_module}:LazyResource")
+
+    assert lazy_module not in sys.modules
+    assert fresh_provider.get("lazy").__name__ == "LazyResource"
+    assert lazy_module in sys.modules
+
+
+def test__register_manifest__resolved_with_lifetime(fresh_provider, lazy_module):
+    fresh_provider.register_manifest({"lazy": {"target": f"{lazy_module}:LazyResource", "lifetime": "singleton"}})
+
+    assert fresh_provider.resolve("lazy") is fresh_provider.resolve("lazy")
+
+
+def test__register_lazy_resolve_concurrently__imported_once(fresh_provider, lazy_module):
+    fresh_provider.register_lazy("lazy", f"{lazy_module}:LazyResource")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(fresh_provider.get("lazy"))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sys.modules[lazy_module].imports) == 1
+    assert all(result is results[0] for result in results)
+
+
+class Repository:
+    pass
+
+
+class ReportService:
+    def __init__(self, repository: Repository) -> None:
+        self.repository = repository
+
+
+def test__register_lazy_dependency__injected(fresh_provider, lazy_module):
+    fresh_provider.register_lazy(Repository, f"{lazy_module}:LazyResource")
+    fresh_provider.register(ReportService)
+
+    assert type(fresh_provider.resolve(ReportService).repository).__name__ == "LazyResource"
+
+
+def test__register_lazy_key__exception_thrown(fresh_provider, lazy_module):
+    fresh_provider.register_lazy("lazy", f"{lazy_module}:LazyResource")
+
+    with pytest.raises(KeyError):
+        fresh_provider.register(TestClass, key="lazy")
+
+
+def test__register_lazy_self_registering_module__registered_once(fresh_provider, tmp_path, monkeypatch):
+    (tmp_path / "self_registering.py").write_text(
+        "from provider import provider\n"
+        "@provider.register(key='lazy')\n"
+        "class SelfRegistered:\n"
+        "    pass\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "self_registering", raising=False)
+    fresh_provider.register_lazy("lazy", "self_registering:SelfRegistered")
+
+    assert fresh_provider.get("lazy").__name__ == "SelfRegistered"
+    assert "lazy" not in Provider.instance.lazy
+
+
+class AsyncClient:
+    pass
+
+
+def test__aget_async_singleton_concurrently__created_once(fresh_provider):
+    created = []
+
+    async def make_client() -> AsyncClient:
+        await asyncio.sleep(0.01)
+        created.append(1)
+        return AsyncClient()
+
+    fresh_provider.register(make_client, key="client", lifetime=Lifetime.SINGLETON)
+
+    async def main():
+        return await asyncio.gather(*(fresh_provider.aget("client") for _ in range(10)))
+
+    clients = asyncio.run(main())
+
+    assert len(created) == 1
+    assert all(client is clients[0] for client in clients)
+
+
+def test__resolve_async_factory__exception_thrown(fresh_provider):
+    async def make_client():
+        return AsyncClient()
+
+    fresh_provider.register(make_client, key="client")
+
+    with pytest.raises(TypeError):
+        fresh_provider.resolve("client")
+
+
+def test__warm_up__singletons_created_concurrently_after_dependencies(fresh_provider):
+    events = []
+
+    async def make_config() -> Config:
+        events.append("config")
+        return Config()
+
+    async def make_first(config: Config):
+        events.append("first start")
+        await asyncio.sleep(0.02)
+        events.append("first end")
+        return config
+
+    async def make_second(config: Config):
+        events.append("second start")
+        await asyncio.sleep(0.02)
+        events.append("second end")
+        return config
+
+    fresh_provider.register(make_config, key=Config, lifetime=Lifetime.SINGLETON)
+    fresh_provider.register(make_first, key="first", lifetime=Lifetime.SINGLETON)
+    fresh_provider.register(make_second, key="second", lifetime=Lifetime.SINGLETON)
+
+    asyncio.run(fresh_provider.warm_up())
+
+    assert events[0] == "config"
+    assert set(events[1:3]) == {"first start", "second start"}
+    assert fresh_provider.resolve("first") is fresh_provider.resolve("second")
+
+
+def test__aget_sync_factory_returning_awaitable__awaited(fresh_provider):
+    async def make_client():
+        return AsyncClient()
+
+    fresh_provider.register(lambda: make_client(), key="client", lifetime=Lifetime.SINGLETON)
+
+    assert isinstance(asyncio.run(fresh_provider.aget("client")), AsyncClient)
+
+
+def test__warm_up_unhinted_transient__singletons_created(fresh_provider):
+    def handler(event, context):
+        pass
+
+    fresh_provider.register(handler, key="handler")
+    fresh_provider.register(Config, lifetime=Lifetime.SINGLETON)
+
+    asyncio.run(fresh_provider.warm_up())
+
+    assert Config in Provider.instance.instances
+
+
+def test__aget_and_resolve_sync_singleton_concurrently__created_once(fresh_provider):
+    created = []
+
+    def make_slow():
+        time.sleep(0.05)
+        created.append(1)
+        return Config()
+
+    fresh_provider.register(make_slow, key="slow", lifetime=Lifetime.SINGLETON)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(fresh_provider.resolve("slow")))
+    thread.start()
+    results.append(asyncio.run(fresh_provider.aget("slow")))
+    thread.join()
+
+    assert len(created) == 1
+    assert results[0] is results[1]
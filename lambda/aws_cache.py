@@ -0,0 +1 @@
+../scripts/aws_cache.py
\ No newline at end of file
@@ -0,0 +1 @@
+../scripts/ec2_batch.py
\ No newline at end of file
@@ -0,0 +1 @@
+../scripts/ec2_records.py
\ No newline at end of file
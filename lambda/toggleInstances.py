@@ -1,89 +1,142 @@
 #!/usr/bin/python3
 
-import boto3
+import aws_cache
+import ec2_batch
+from ec2_records import InstanceRecord
+import io
 import os
 from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 states = {'on': 'stopped', 'off': 'running'}
 exec_data = {
     'on': {
-        'filter': lambda i, t, v: marked(t, i['tags'], v),
+        'filter': lambda i, t, v: marked(t, i.tags, v),
         # 'action': lambda ec2client, instances: print('start', len(instances)),
-        'action': lambda ec2client, instances: getInstanceIds(ec2client, instances).start(),
+        'action': lambda ec2client, instances: ec2_batch.start_instances(ec2client.meta.client, getInstanceIds(instances)),
         'event_tags': 'applyTags',
-        'filter_value': 'true'
+        'filter_value': 'true',
+        'server_side': True  # "any tag is marked" maps to tag:<key> filters
     },
     'off': {
-        'filter': lambda i, t, v: not marked(t, i['tags'], v),
+        'filter': lambda i, t, v: not marked(t, i.tags, v),
         # 'action': lambda ec2client, instances: print('stop', len(instances)),
-        'action': lambda ec2client, instances: getInstanceIds(ec2client, instances).stop(),
+        'action': lambda ec2client, instances: ec2_batch.stop_instances(ec2client.meta.client, getInstanceIds(instances)),
         'event_tags': 'ignoredTags',
-        'filter_value': 'false'
+        'filter_value': 'false',
+        'server_side': False  # negation can't be expressed as an EC2 filter
     },
 }
+DEFAULT_MAX_WORKERS = 8
+PAGE_SIZE = 200
+# a batch spans several chunks, so ec2_batch sends them concurrently
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', ec2_batch.CHUNK_SIZE * ec2_batch.MAX_WORKERS))
+SENDING_BATCHES = 2
 
 
 def lambda_handler(event, context):
     print(event)
-    regionsResponse = boto3.client('ec2').describe_regions()
-    for region in regionsResponse['Regions']:
-        ec2client = boto3.resource('ec2', region_name=region['RegionName'])
-        # filter instances to retrieve all relevant EC2 instances.
-        instancesToToggle = filterInstances(ec2client, event['action'])
+    regionNames = aws_cache.get_regions()
+    maxWorkers = int(event.get('maxWorkers', os.environ.get('MAX_WORKERS', DEFAULT_MAX_WORKERS)))
 
-        print(f"Region {region}: ", end='')
-        perform_action(ec2client, instancesToToggle, event)
+    summary = {}
+    with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor:
+        futures = {executor.submit(handle_region, regionName, event): regionName for regionName in regionNames}
+        for future in as_completed(futures):
+            regionName = futures[future]
+            try:
+                output, summary[regionName] = future.result()
+            except Exception as ex:
+                output = f"Region {regionName}: failed - {type(ex).__name__}: {ex}\n"
+                summary[regionName] = {'status': 'error', 'error': str(ex)}
+            print(output, end='')  # one block per region, so logs don't interleave
 
+    failed = [regionName for regionName, result in summary.items() if result['status'] == 'error']
+    print(f"Done: {len(summary) - len(failed)} regions ok, {len(failed)} failed {failed}")
+    return summary
 
-def getInstanceIds(ec2client, instances):
-    return ec2client.instances.filter(InstanceIds=[instance['id'] for instance in instances])
 
+def handle_region(regionName, event):
+    """Runs the toggle for a single region, returns its buffered output and result"""
+    output = io.StringIO()
+    # pooled per region, a region is only ever handled by one worker at a time
+    ec2client = aws_cache.resource('ec2', regionName)
+    # lazily stream relevant EC2 instances, batches are toggled while later pages are still listed
+    instancesToToggle = iterInstances(ec2client, event)
 
-def filterInstances(ec2client, action):
-    filters = [{'Name': 'instance-state-name', 'Values': [states[action]]}]  # running/stopped
-    return [extract_instance_data(instance) for instance in ec2client.instances.filter(Filters=filters)]
+    print(f"Region {regionName}: ", end='', file=output)
+    results = perform_action(ec2client, instancesToToggle, event, file=output)
+    return output.getvalue(), {'status': 'ok', 'results': results}
 
 
-def perform_action(ec2client, instances, event):
-    action = event['action']
-    action_data = exec_data[action]
-    filtered = filter_by_tags(instances, event[action_data['event_tags']],
-                              action_data['filter_value'], action_data['filter'])
-    if len(filtered) == 0:
-        print(f"Nothing to power {action}.")
-    else:
-        print(f"Powering", action, f"{len(filtered)} instances: {[instance['name'] for instance in filtered]}")
-        action_data['action'](ec2client, filtered)
-
-
-def extract_instance_data(instance):
-    return {
-        'id': instance.id,
-        'name': extract_name_tag(instance.tags),
-        'tags': flatten(instance.tags)
-    }
-
-
-def extract_name_tag(tags):
-    if tags is None:
-        return "UNKNOWN NAME"
-    return [item['Value'] for item in tags if item['Key'] == 'Name'][0]
+def getInstanceIds(instances):
+    return [instance.id for instance in instances]
 
 
-def flatten(tags):
-    flat = {}
-    if tags is not None:
-        for item in tags:
-            flat[item['Key']] = item['Value']
-    return flat
+def plan_filters(event):
+    """Translates the event tag rules into EC2 filters
 
-
-def filter_by_tags(instances, tags, value, filterFunc):
-    filtered = []
-    for inst in instances:
-        if filterFunc(inst, tags, value):
-            filtered.append(inst)
-    return filtered
+    Returns (queries, localFilter): a list of filter lists whose results are unioned,
+    and the filter still to be evaluated locally, or None if EC2 already applied it.
+    """
+    action = event['action']
+    action_data = exec_data[action]
+    stateFilter = {'Name': 'instance-state-name', 'Values': [states[action]]}  # running/stopped
+    if not action_data['server_side']:
+        return [[stateFilter]], action_data['filter']
+    # marked() is an OR over the tag keys while EC2 ANDs filters, so query each key on its own
+    tagFilters = [{'Name': f"tag:{tag}", 'Values': [action_data['filter_value']]}
+                  for tag in event[action_data['event_tags']]]
+    return [[stateFilter, tagFilter] for tagFilter in tagFilters], None
+
+
+def iterInstances(ec2client, event):
+    """Lazily yields data of instances matching the event, one describe_instances page at a time"""
+    action_data = exec_data[event['action']]
+    queries, localFilter = plan_filters(event)
+    seen = set()
+    for filters in queries:
+        for instance in ec2client.instances.filter(Filters=filters).page_size(PAGE_SIZE):
+            if instance.id in seen:
+                continue
+            seen.add(instance.id)
+            data = InstanceRecord.from_instance(instance)
+            if localFilter is None or localFilter(data, event[action_data['event_tags']], action_data['filter_value']):
+                yield data
+
+
+def filterInstances(ec2client, event):
+    return list(iterInstances(ec2client, event))
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def perform_action(ec2client, instances, event, file=None):
+    """Sends the action for every batch of `instances` as soon as it fills, listing goes on meanwhile"""
+    action = event['action']
+    action_data = exec_data[action]
+    results = []
+    with ThreadPoolExecutor(max_workers=SENDING_BATCHES) as sender:
+        sent = []
+        for batch in batched(instances, BATCH_SIZE):
+            print(f"Powering", action, f"{len(batch)} instances: {[instance.name for instance in batch]}", file=file)
+            sent.append(sender.submit(action_data['action'], ec2client, batch))
+        for future in sent:
+            results.extend(future.result())
+    if len(results) == 0:
+        print(f"Nothing to power {action}.", file=file)
+    else:
+        print(f"\t{ec2_batch.describe_results(results)}", file=file)
+    return results
 
 
 def marked(ignoredTags, instTags, value):
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+"""Region list and boto3 client cache
+The region list is persisted to a local json file with a TTL, clients and
+resources are pooled per (service, region, profile). Both live at module
+level, so they survive warm lambda invocations.
+
+Shared by the scripts in this folder and lambda/toggleInstances.py
+(lambda/aws_cache.py is a symlink to this file).
+"""
+
+import json
+import os
+import threading
+import time
+import boto3
+
+REGIONS_TTL = int(os.environ.get('AWS_REGIONS_TTL', 24 * 60 * 60))
+REGIONS_CACHE_PATH = os.environ.get(
+    'AWS_REGIONS_CACHE',
+    '/tmp/aws_regions.json' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ  # only /tmp is writable in lambda
+    else os.path.expanduser('~/.cache/aws_regions.json'))
+
+_lock = threading.Lock()
+_sessions = {}
+_pool = {}
+_regions = {}
+
+
+def session(profile=None):
+    with _lock:
+        if profile not in _sessions:
+            _sessions[profile] = boto3.session.Session(profile_name=profile)
+        return _sessions[profile]
+
+
+def client(service, region_name=None, profile=None):
+    return _pooled('client', service, region_name, profile)
+
+
+def resource(service, region_name=None, profile=None):
+    """Pooled boto3 resource, resources aren't thread safe - share one per region, not across threads"""
+    return _pooled('resource', service, region_name, profile)
+
+
+def _pooled(kind, service, region_name, profile):
+    key = (kind, service, region_name, profile)
+    pooled = _pool.get(key)
+    if pooled is None:
+        profileSession = session(profile)
+        with _lock:  # creating clients from a shared session isn't thread safe
+            pooled = _pool.get(key)
+            if pooled is None:
+                pooled = getattr(profileSession, kind)(service, region_name=region_name)
+                _pool[key] = pooled
+    return pooled
+
+
+def get_regions(profile=None, ttl=REGIONS_TTL):
+    """Region names of the account, from memory, then disk, then describe_regions"""
+    cacheKey = profile or 'default'
+    cached = _regions.get(cacheKey)
+    if cached is None or time.time() - cached['time'] > ttl:
+        cached = _load_regions().get(cacheKey)
+    if cached is None or time.time() - cached['time'] > ttl:
+        regionsResponse = client('ec2', profile=profile).describe_regions()
+        cached = {'time': time.time(), 'regions': [region['RegionName'] for region in regionsResponse['Regions']]}
+        _store_regions(cacheKey, cached)
+    _regions[cacheKey] = cached
+    return cached['regions']
+
+
+def _load_regions():
+    try:
+        with open(REGIONS_CACHE_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_regions(cacheKey, cached):
+    stored = _load_regions()
+    stored[cacheKey] = cached
+    try:
+        os.makedirs(os.path.dirname(REGIONS_CACHE_PATH), exist_ok=True)
+        with open(REGIONS_CACHE_PATH, 'w') as file:
+            json.dump(stored, file)
+    except OSError:
+        pass  # cache is best effort, the in memory copy still holds
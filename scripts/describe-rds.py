@@ -1,11 +1,18 @@
 #!/usr/bin/python3
 
-import boto3
+import aws_cache
 import argparse
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from os import system
 from AwsRegionsDictionary.RegionsMapping import mapToRegionKey # https://github.com/go-dima/aws-regions-dictionary
 
+MAX_WORKERS = 16
+MIN_INTERVAL = 5
+MAX_INTERVAL = 30
+BACKOFF = 1.5
+
 
 class color:
     PURPLE = '\033[95m'
@@ -51,32 +58,106 @@ def parse_args():
 def clear(): return system('clear')
 
 
-def describe_region(region_name):
-    rdsClient = boto3.client('rds', region_name=region_name)
-    response = rdsClient.describe_db_instances()
-    instances = response['DBInstances']
-    output = f"{region_name}: {len(instances)} rds instances"
-    ready = True
-    if len(instances) > 0:
-        print(color.BOLD + output + color.END)
+def fetch_instances(region_name, identifiers=None):
+    """All rds instances of a region, following `Marker` pagination, optionally only `identifiers`"""
+    rdsClient = aws_cache.client('rds', region_name)
+    request = {}
+    if identifiers:
+        request['Filters'] = [{'Name': 'db-instance-id', 'Values': identifiers}]
+    instances = []
+    while True:
+        response = rdsClient.describe_db_instances(**request)
+        instances.extend(response['DBInstances'])
+        if not response.get('Marker'):
+            return instances
+        request['Marker'] = response['Marker']
+
+
+def fetch_regions(region_names, identifiers=None):
+    """Queries regions concurrently, returns {region_name: instances} in `region_names` order"""
+    def fetch(region_name):
+        return fetch_instances(region_name, identifiers[region_name] if identifiers else None)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return dict(zip(region_names, executor.map(fetch, region_names)))
+
+
+def describe_instance(instance):
+    instanceDesc = f"{underline(instance['DBInstanceIdentifier'])} of type {underline(instance['DBInstanceClass'])} is {status_to_srt(instance['DBInstanceStatus'])}"
+    return "\t{}".format(instanceDesc)
+
+
+def describe_gone(identifier):
+    return f"\t{underline(identifier)} is {color.RED}gone{color.END}"
+
+
+def render(regions):
+    """Prints all regions, returns the screen row of every (region_name, identifier) and the row below the output"""
+    rows = {}
+    row = 1
+    for region_name, instances in regions.items():
+        output = f"{region_name}: {len(instances)} rds instances"
+        print(color.BOLD + output + color.END if len(instances) > 0 else output)
+        row += 1
         for instance in instances:
-            instanceDesc = f"{underline(instance['DBInstanceIdentifier'])} of type {underline(instance['DBInstanceClass'])} is {status_to_srt(instance['DBInstanceStatus'])}"
-            print("\t{}".format(instanceDesc))
-            if instance['DBInstanceStatus'] != "available":
-                ready = False
-    else:
-        print(output)
-    return ready
+            print(describe_instance(instance))
+            rows[(region_name, instance['DBInstanceIdentifier'])] = row
+            row += 1
+    return rows, row
+
+
+def redraw(row, line, bottom):
+    """Rewrites a single screen row in place and moves the cursor back below the output"""
+    print(f"\033[{row};1H\033[2K{line}\033[{bottom};1H", end='', flush=True)
+
+
+def watch(region_names):
+    """Redraws until all instances are available or gone, re-polling only the ones that aren't"""
+    regions = fetch_regions(region_names)
+    statuses = {(region_name, instance['DBInstanceIdentifier']): instance['DBInstanceStatus']
+                for region_name, instances in regions.items() for instance in instances}
+    clear()
+    rows, bottom = render(regions)
+    interval = MIN_INTERVAL
+    while True:
+        pending = {}
+        for (region_name, identifier), status in statuses.items():
+            if status != 'available':
+                pending.setdefault(region_name, []).append(identifier)
+        if len(pending) == 0:
+            return
+        time.sleep(interval)
+        changed = False
+        inPlace = bottom <= shutil.get_terminal_size().lines  # otherwise the output scrolled, rows are off
+        for region_name, instances in fetch_regions(list(pending), pending).items():
+            # deleted instances are no longer returned by the db-instance-id filter, stop waiting on them
+            gone = set(pending[region_name]) - {instance['DBInstanceIdentifier'] for instance in instances}
+            for identifier in gone:
+                del statuses[(region_name, identifier)]
+                changed = True
+                regions[region_name] = [known for known in regions[region_name]
+                                        if known['DBInstanceIdentifier'] != identifier]
+                if inPlace:
+                    redraw(rows[(region_name, identifier)], describe_gone(identifier), bottom)
+            for instance in instances:
+                key = (region_name, instance['DBInstanceIdentifier'])
+                if statuses.get(key) != instance['DBInstanceStatus']:
+                    statuses[key] = instance['DBInstanceStatus']
+                    changed = True
+                    regions[region_name] = [instance if known['DBInstanceIdentifier'] == key[1] else known
+                                            for known in regions[region_name]]
+                    if inPlace:
+                        redraw(rows[key], describe_instance(instance), bottom)
+        if changed and not inPlace:
+            clear()
+            rows, bottom = render(regions)
+        interval = MIN_INTERVAL if changed else min(MAX_INTERVAL, interval * BACKOFF)
 
 
 args = parse_args()
+regionNames = [mapToRegionKey(args.region)] if args.region else aws_cache.get_regions()
 
-if args.region:
-    while not describe_region(mapToRegionKey(args.region)) and args.watch:
-        time.sleep(30)
-        clear()
+if args.watch:
+    watch(regionNames)
 else:
-    ec2Client = boto3.client('ec2')
-    regionsResponse = ec2Client.describe_regions()
-    for region in regionsResponse['Regions']:
-        describe_region(region['RegionName'])
+    render(fetch_regions(regionNames))
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+"""Batched EC2 start/stop
+Splits instance id lists into API sized chunks, sends the chunks concurrently
+and retries throttled chunks with jittered exponential backoff.
+
+Shared by scripts/manage-instances.py and lambda/toggleInstances.py
+(lambda/ec2_batch.py is a symlink to this file, so it gets packaged with the lambda).
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+CHUNK_SIZE = 50
+MAX_WORKERS = 4
+MAX_RETRIES = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+THROTTLE_CODES = {'RequestLimitExceeded', 'Throttling', 'ThrottlingException'}
+# caused by a single instance of the chunk, the chunk is split to find it and still change the others
+INSTANCE_ERROR_CODES = {'IncorrectInstanceState', 'InvalidInstanceID.NotFound', 'InvalidInstanceID.Malformed'}
+
+
+def start_instances(ec2client, instance_ids, **kwargs):
+    """Starts instances, returns a result per instance id"""
+    return run_batched(ec2client.start_instances, instance_ids, 'StartingInstances', **kwargs)
+
+
+def stop_instances(ec2client, instance_ids, **kwargs):
+    """Stops instances, returns a result per instance id"""
+    return run_batched(ec2client.stop_instances, instance_ids, 'StoppingInstances', **kwargs)
+
+
+def run_batched(call, instance_ids, result_key, chunk_size=CHUNK_SIZE, max_workers=MAX_WORKERS, max_retries=MAX_RETRIES):
+    """Runs `call(InstanceIds=chunk)` for every chunk of `instance_ids`
+
+    Returns a list of {'id', 'previous', 'current'} dicts, or {'id', 'error'} for
+    instances whose chunk failed, in the order of `instance_ids`. Chunks failing on one
+    instance's state or id are bisected, so the error is reported on that instance only.
+    """
+    chunks = [instance_ids[i:i + chunk_size] for i in range(0, len(instance_ids), chunk_size)]
+    if len(chunks) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        chunk_results = executor.map(lambda chunk: _run_chunk(call, chunk, result_key, max_retries), chunks)
+        results = {}
+        for chunk_result in chunk_results:
+            results.update(chunk_result)
+    return [results[instance_id] for instance_id in instance_ids]
+
+
+def _run_chunk(call, chunk, result_key, max_retries):
+    attempt = 0
+    while True:
+        try:
+            response = call(InstanceIds=chunk)
+            break
+        except ClientError as err:
+            code = err.response.get('Error', {}).get('Code')
+            if code in THROTTLE_CODES and attempt < max_retries:
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            if code in INSTANCE_ERROR_CODES and len(chunk) > 1:
+                middle = len(chunk) // 2
+                return {**_run_chunk(call, chunk[:middle], result_key, max_retries),
+                        **_run_chunk(call, chunk[middle:], result_key, max_retries)}
+            return {instance_id: {'id': instance_id, 'error': code or str(err)} for instance_id in chunk}
+
+    results = {instance_id: {'id': instance_id, 'error': 'missing from response'} for instance_id in chunk}
+    for change in response.get(result_key, []):
+        results[change['InstanceId']] = {
+            'id': change['InstanceId'],
+            'previous': change['PreviousState']['Name'],
+            'current': change['CurrentState']['Name']
+        }
+    return results
+
+
+def backoff_delay(attempt):
+    """Full jitter: uniform in [0, min(MAX_DELAY, BASE_DELAY * 2^attempt)]"""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def describe_results(results):
+    """One line summary of start/stop results"""
+    changed = [result for result in results if 'error' not in result and result['previous'] != result['current']]
+    failed = [f"{result['id']} ({result['error']})" for result in results if 'error' in result]
+    summary = f"{len(changed)}/{len(results)} changed state"
+    if failed:
+        summary += f", failed: {failed}"
+    return summary
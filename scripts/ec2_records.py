@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+"""Compact EC2 instance records
+Built in a single pass over `instance.tags`, with interned tag keys so the
+same key string is shared between all records of a run.
+
+Shared by scripts/manage-instances.py and lambda/toggleInstances.py
+(lambda/ec2_records.py is a symlink to this file).
+"""
+
+import sys
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+UNKNOWN_NAME = "UNKNOWN NAME"
+
+
+@dataclass(frozen=True, slots=True)
+class InstanceRecord:
+    id: str
+    name: str
+    tags: Dict[str, str]
+    ip: Optional[str] = None
+    state: Optional[str] = None
+
+    @classmethod
+    def from_instance(cls, instance, details=False):
+        """Builds a record from a boto3 ec2.Instance, `details` adds public ip and state"""
+        name = UNKNOWN_NAME
+        tags = {}
+        for item in instance.tags or ():
+            key = sys.intern(item['Key'])
+            tags[key] = item['Value']
+            if key == 'Name':
+                name = item['Value']
+        if not details:
+            return cls(instance.id, name, tags)
+        return cls(instance.id, name, tags, instance.public_ip_address, instance.state['Name'])
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+"""Wait for EC2 instances to reach a state
+Polls only the instance ids still pending, with an adaptive interval,
+and reports progress as instances become ready.
+"""
+
+import time
+from ec2_records import InstanceRecord
+
+FIRST_INTERVAL = 2
+MAX_INTERVAL = 15
+BACKOFF = 1.5
+DEFAULT_TIMEOUT = 600
+
+
+def is_ready(record, state, require_ip):
+    return record.state == state and (not require_ip or record.ip is not None)
+
+
+def wait_for_instances(ec2client, instance_ids, state='running', require_ip=False, timeout=DEFAULT_TIMEOUT,
+                       progress=print):
+    """Waits until all `instance_ids` are in `state` (and have a public ip, if `require_ip`)
+
+    Returns (ready, pending): records of the ready instances and ids still pending on timeout.
+    """
+    pending = list(instance_ids)
+    ready = {}
+    interval = FIRST_INTERVAL
+    deadline = time.monotonic() + timeout
+    while True:
+        for instance in ec2client.instances.filter(InstanceIds=pending):
+            record = InstanceRecord.from_instance(instance, details=True)
+            if is_ready(record, state, require_ip):
+                ready[record.id] = record
+                progress(f"{record.name}: {record.ip} - {record.state} ({len(ready)}/{len(instance_ids)} ready)")
+        pending = [instance_id for instance_id in pending if instance_id not in ready]
+        if len(pending) == 0 or time.monotonic() >= deadline:
+            return [ready[instance_id] for instance_id in instance_ids if instance_id in ready], pending
+        time.sleep(min(interval, max(0, deadline - time.monotonic())))
+        interval = min(MAX_INTERVAL, interval * BACKOFF)
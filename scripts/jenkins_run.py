@@ -18,13 +18,22 @@ import argparse
 import json
 import logging
 import os
+import random
 import subprocess
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 
 class CustomHTTPError(Exception):
-    pass
+    def __init__(self, message, status_code=None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
 
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -42,6 +51,23 @@ FLIP_ACTION = {
     "/build": "/buildWithParameters",
     "/buildWithParameters": "/build"
 }
+CONNECT_TIMEOUT = float(os.environ.get("JENKINS_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.environ.get("JENKINS_READ_TIMEOUT", 30))
+POOL_SIZE = 10
+MAX_RETRIES = 3
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+RETRY_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD"}
+BUILD_TREE = "building,result,duration,estimatedDuration,url,number"
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 30
+BATCH_WORKERS = 8
+QUEUE_TIMEOUT = int(os.environ.get("JENKINS_QUEUE_TIMEOUT", 30 * 60))
+JOB_CACHE_PATH = os.environ.get("JENKINS_JOB_CACHE", os.path.expanduser("~/.cache/jenkins_jobs.json"))
+JOB_CACHE_TTL = int(os.environ.get("JENKINS_JOB_CACHE_TTL", 24 * 60 * 60))
+MISSING_JOB_TTL = 60  # a missing branch may show up after `scan-repo`
+JOB_TREE = "property[parameterDefinitions[name]],actions[parameterDefinitions[name]],lastBuild[duration]"
 
 urls = {
     "start-jobname1": f"{JENKINS_URL}/job/folder1/job/jobname1/job/main/build",
@@ -50,6 +76,76 @@ urls = {
 }
 
 
+class JobCache:
+    """On disk job metadata keyed by job url: existence, parameter names and last build duration"""
+
+    def __init__(self, path, ttl) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.path) as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def _store(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as file:
+                json.dump(self.entries, file)
+        except OSError as err:
+            logger.debug(f"Failed to write job cache: {err}")
+
+    def get(self, job_url):
+        """Cached metadata, fetched from jenkins when missing or expired, None if it can't be fetched"""
+        with self.lock:
+            entry = self._load().get(job_url)
+        ttl = self.ttl if entry and entry["exists"] else MISSING_JOB_TTL
+        if entry and time.time() - entry["time"] < ttl:
+            return entry
+        entry = fetch_job_metadata(job_url)
+        if entry is not None:
+            with self.lock:
+                self._load()[job_url] = entry
+                self._store()
+        return entry
+
+    def invalidate(self, job_url):
+        with self.lock:
+            if self._load().pop(job_url, None) is not None:
+                self._store()
+
+
+def fetch_job_metadata(job_url):
+    try:
+        reply = send_with_retry(job_url + "/api/json", None, method="GET", params={"tree": JOB_TREE})
+    except CustomHTTPError as err:
+        if err.status_code == 404:
+            return {"exists": False, "time": time.time()}
+        return None
+    except requests.exceptions.RequestException:
+        return None
+    job = reply.json()
+    parameters = [definition["name"]
+                  for holder in job.get("property", []) + job.get("actions", []) if holder
+                  for definition in holder.get("parameterDefinitions", [])]
+    return {
+        "exists": True,
+        "parameters": sorted(set(parameters)),
+        "last_duration": (job.get("lastBuild") or {}).get("duration", 0),
+        "time": time.time()
+    }
+
+
+job_cache = JobCache(JOB_CACHE_PATH, JOB_CACHE_TTL)
+
+
 class Job:
     base_url: str
     action: str
@@ -59,48 +155,186 @@ class Job:
         self.action = _action
 
     def format_url(self, repo, branch):
-        self.base_url = self.base_url.replace("REPO", repo).replace("BRANCH", branch)
-
-    def build(self, data=None):
+        """Returns a copy of the job for the given repo and branch, the shared `urls` entry is kept as is"""
+        return Job(self.base_url.replace("REPO", repo).replace("BRANCH", branch), self.action)
+
+    def apply_metadata(self, data):
+        """Picks the endpoint from cached job metadata and validates `data` against the declared parameters
+
+        Returns False if there is no metadata and the endpoint is still a guess.
+        """
+        metadata = job_cache.get(self.base_url)
+        if metadata is None:
+            return False  # unknown, trigger falls back to flipping
+        if not metadata["exists"]:
+            raise CustomHTTPError(f"{self.base_url} not found", 404)
+        parameters = metadata["parameters"]
+        self.action = "/buildWithParameters" if parameters else "/build"
+        unknown = sorted(set(data or {}) - set(parameters))
+        if unknown:
+            raise ValueError(f"Unknown parameters {unknown}, job accepts {parameters}")
+        return True
+
+    def trigger(self, data=None):
+        """Triggers the job, flips between /build and /buildWithParameters once if the endpoint was only a guess"""
+        from_metadata = self.apply_metadata(data)
         logger.info(f"Building {self.base_url + self.action}")
         try:
             return send_with_retry(self.base_url + self.action, data)
-        except requests.HTTPError as err:
-            if err.response.status_code == 404:
-                logger.error("URL Not found - Is is a new branch? Try running `scan-repo` first.")
-                exit(1)
-        except CustomHTTPError:
+        except CustomHTTPError as err:
+            job_cache.invalidate(self.base_url)
+            if from_metadata or err.status_code == 404:
+                raise
             logger.info(f"Failed to build with {self.action}, flipping")
             self.action = FLIP_ACTION[self.action]
-            self.build()
+            logger.info(f"Building {self.base_url + self.action}")
+            return send_with_retry(self.base_url + self.action, data)
+
+    def build(self, data=None):
+        try:
+            return self.trigger(data)
+        except CustomHTTPError as err:
+            if err.status_code == 404:
+                logger.error("URL Not found - Is is a new branch? Try running `scan-repo` first.")
+            else:
+                logger.error(f"Failed to build: {err}")
+            exit(1)
+        except ValueError as err:
+            logger.error(err)
+            exit(1)
         except requests.exceptions.ProxyError:
             logger.error("Blocked by proxy!")
             exit(1)
+        except requests.exceptions.ReadTimeout:
+            logger.error("Jenkins didn't answer in time, the build may still have been queued - check before re-running")
+            exit(1)
         except Exception as ex:
             logger.error(f"Caught something: {type(ex).__name__}, {type(ex)}")
             logger.error(f"Details: {ex}")
             exit(1)
 
     def get_latest_build(self):
-        return send_with_retry(self.base_url + LAST_BUILD_URL, None)
+        return send_with_retry(self.base_url + LAST_BUILD_URL, None, method="GET")
+
+    def poll_interval(self):
+        """Poll interval derived from the cached last build duration, ~20 polls per build"""
+        metadata = job_cache.get(self.base_url)
+        duration_ms = metadata.get("last_duration", 0) if metadata else 0
+        return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, duration_ms / 1000 / 20))
+
+    def wait_for_start(self, trigger_reply):
+        """Follows the queue item from the trigger reply to the build it started, returns the build json"""
+        queue_url = trigger_reply.headers.get("Location") if trigger_reply is not None else None
+        if not queue_url:
+            logger.info("No queue item returned, falling back to the latest build")
+            time.sleep(10)  # Let the job start
+            return self.get_latest_build().json()
+        queue_api = queue_url.rstrip("/") + "/api/json"
+        interval = MIN_POLL_INTERVAL
+        deadline = time.monotonic() + QUEUE_TIMEOUT
+        while True:
+            item = send_with_retry(queue_api, None, method="GET",
+                                   params={"tree": "cancelled,why,executable[number,url]"}).json()
+            if item.get("cancelled"):
+                raise CustomHTTPError(f"Queue item {queue_url} was cancelled")
+            if item.get("executable"):
+                return item["executable"]
+            logger.debug(f"Queued: {item.get('why')}")
+            if time.monotonic() >= deadline:
+                logger.info(f"Still queued after {QUEUE_TIMEOUT}s: {item.get('why')}")
+                raise TimeoutError(f"Queue item {queue_url} didn't start within {QUEUE_TIMEOUT}s: {item.get('why')}")
+            time.sleep(min(interval, max(0, deadline - time.monotonic())))
+            interval = min(MAX_POLL_INTERVAL, interval * 1.5)
+
+    def wait_for_build(self, build_url, stream_console=True):
+        """Polls the build until it finishes, streaming new console output on every poll, returns the result"""
+        interval = self.poll_interval()
+        build_api = build_url.rstrip("/") + "/api/json"
+        console_url = build_url.rstrip("/") + "/logText/progressiveText"
+        offset = 0
+        while True:
+            build = send_with_retry(build_api, None, method="GET", params={"tree": BUILD_TREE}).json()
+            if stream_console:
+                offset = stream_console_output(console_url, offset)
+            if not build.get("building"):
+                return build.get("result")
+            time.sleep(interval)
+
+
+def stream_console_output(console_url, offset):
+    """Prints console text written since `offset`, returns the next offset"""
+    while True:
+        reply = send_with_retry(console_url, None, method="GET", params={"start": offset})
+        print(reply.text, end="", flush=True)
+        offset = int(reply.headers.get("X-Text-Size", offset))
+        if not reply.text or reply.headers.get("X-More-Data") != "true":
+            return offset
+
+
+def make_session() -> requests.Session:
+    """Keep-alive session, connections are reused between calls"""
+    new_session = requests.Session()
+    new_session.auth = creds
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+    return new_session
+
+
+session = make_session()
+
+
+def retry_delay(attempt, reply=None):
+    """Seconds to wait before retry `attempt`: Retry-After if given, else exponential backoff with full jitter"""
+    retry_after = reply.headers.get("Retry-After") if reply is not None else None
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                return min(BACKOFF_MAX, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def never_sent(err):
+    """True if the request can't have reached Jenkins: connect timeout or refused/unresolved connection"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], "reason", None) if err.args else None
+    return isinstance(reason, NewConnectionError)
 
 
-def send_with_retry(jenkins_job_url, data) -> requests.Response:
-    """Sends post with 3 retries"""
+def send_with_retry(jenkins_job_url, data, method="POST", params=None) -> requests.Response:
+    """Sends request (post by default), retries connection errors, timeouts and 429/503 up to MAX_RETRIES times with backoff
+
+    A POST is retried on errors only if it never reached Jenkins, after a read timeout the build may
+    already be queued and retrying could start it twice.
+    """
     logger.debug(jenkins_job_url)
-    retries = 0
-    while retries < 3:
+    attempt = 0
+    while True:
         try:
-            reply = requests.post(jenkins_job_url, data=data, auth=creds)
-            reply.raise_for_status()
-            return reply
+            reply = session.request(method, jenkins_job_url, data=data, params=params,
+                                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if reply.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                delay = retry_delay(attempt, reply)
+                logger.debug(f"Got {reply.status_code}, retrying in {delay:.1f}s")
+            else:
+                reply.raise_for_status()
+                return reply
         except requests.exceptions.ProxyError as proxy_err:
             raise proxy_err
         except requests.exceptions.HTTPError:
-            raise CustomHTTPError(f"HttpError {reply.status_code}")
-        except requests.exceptions.ConnectionError as err:
-            logger.debug(f"Caught {err}\nRetrying")
-            retries += 1
+            raise CustomHTTPError(f"HttpError {reply.status_code}", reply.status_code)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            if attempt >= MAX_RETRIES or (method not in IDEMPOTENT_METHODS and not never_sent(err)):
+                raise
+            delay = retry_delay(attempt)
+            logger.debug(f"Caught {err}\nRetrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
 
 
 for key in urls.keys():
@@ -115,12 +349,81 @@ def validate_job(value):
     return value
 
 
+def parse_data(value):
+    try:
+        json.loads(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"{value} is not valid json: {err}")
+    return value
+
+
+def format_job(job_name, repo=None, branch=None):
+    """Fresh Job for every call, trigger() sets its action, so the shared `urls` entry is never handed out"""
+    jenkins_job: Job = urls[job_name]
+    if not repo:
+        return Job(jenkins_job.base_url, jenkins_job.action)
+    branch = branch or get_local_git_branch()
+    branch = branch.replace("/", "%252F")  # Fix slash for correct url format
+    return jenkins_job.format_url(repo, branch)
+
+
+def read_batch(batch_file):
+    """Reads `job [repo [branch [json params]]]` lines, blank lines and # comments are skipped"""
+    stream = sys.stdin if batch_file == "-" else open(batch_file)
+    with stream:
+        items = []
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split(maxsplit=3)
+            parts += [None] * (4 - len(parts))
+            job_name, repo, branch, data = parts
+            try:
+                validate_job(job_name)
+                data = json.loads(data) if data else None
+            except (argparse.ArgumentTypeError, ValueError) as err:  # JSONDecodeError is a ValueError
+                logger.error(f"{batch_file}:{line_number}: {err}")
+                exit(1)
+            items.append({"job": job_name, "repo": repo, "branch": branch, "data": data})
+    return items
+
+
+def run_batch_item(item, wait):
+    """Triggers one batch item and optionally waits for it, never raises - errors are part of the result"""
+    result = dict(item, url="", result="")
+    try:
+        jenkins_job = format_job(item["job"], item["repo"], item["branch"])
+        trigger_reply = jenkins_job.trigger(item["data"])
+        if "scan" in item["job"]:
+            result["result"] = "TRIGGERED"
+            return result
+        build = jenkins_job.wait_for_start(trigger_reply)
+        result["url"] = build["url"]
+        result["result"] = jenkins_job.wait_for_build(build["url"], stream_console=False) if wait else "STARTED"
+    except Exception as ex:
+        result["result"] = f"ERROR {type(ex).__name__}: {ex}"
+    return result
+
+
+def run_batch(items, wait, workers):
+    """Triggers (and waits on) all items through a bounded pool, prints a results matrix"""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(lambda item: run_batch_item(item, wait), items))
+    rows = [["JOB", "REPO", "BRANCH", "RESULT", "URL"]] + \
+           [[r["job"], r["repo"] or "", r["branch"] or "", r["result"] or "", r["url"]] for r in results]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        logger.info("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+    return results
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-j', '--job', dest='job',
         action='store', type=validate_job,
-        required=True, help=f"Job to run: {list(urls.keys())}")
+        required=False, help=f"Job to run: {list(urls.keys())}")
     parser.add_argument(
         '--dir', dest='current_dir',
         action='store_true',
@@ -136,12 +439,23 @@ def parse_args():
     parser.add_argument(
         '--wait', dest='wait',
         action='store_true',
-        required=False, help="Wait for job to finish")
+        required=False, help="Wait for job to finish, streaming its console output")
     parser.add_argument(
         '--data', dest='data',
         action='store', type=parse_data,
         required=False, help="Job params")
-    return parser.parse_args()
+    parser.add_argument(
+        '--batch', dest='batch',
+        action='store',
+        required=False, help="File ('-' for stdin) of `job [repo [branch [json params]]]` lines to trigger concurrently")
+    parser.add_argument(
+        '--workers', dest='workers',
+        action='store', type=int, default=BATCH_WORKERS,
+        required=False, help=f"Concurrent triggers in batch mode (default: {BATCH_WORKERS})")
+    args = parser.parse_args()
+    if not args.job and not args.batch:
+        parser.error("one of --job or --batch is required")
+    return args
 
 
 def get_local_git_branch():
@@ -156,25 +470,34 @@ def get_local_git_branch():
 
 if __name__ == '__main__':
     args = parse_args()
-    jenkins_job: Job = urls[args.job]
 
+    if args.batch:
+        results = run_batch(read_batch(args.batch), args.wait, args.workers)
+        failed = [r for r in results if r["result"] not in ("SUCCESS", "STARTED", "TRIGGERED")]
+        exit(1 if failed else 0)
+
+    repo = None
     if args.current_dir or args.repo:
         repo = args.repo or os.getcwd().split("/")[-1]
-        branch = args.branch or get_local_git_branch()
-        branch = branch.replace("/", "%252F")  # Fix slash for correct url format
-        jenkins_job.format_url(repo, branch)
+    jenkins_job = format_job(args.job, repo, args.branch)
 
     if args.data:
         args.data = json.loads(args.data)
 
-    jenkins_job.build(args.data)
+    trigger_reply = jenkins_job.build(args.data)
 
     if "scan" not in args.job:
-        time.sleep(10)  # Let the job start
-        response = jenkins_job.get_latest_build()
-        logger.info(f"Latest build:\n\t{response.json()['url']}")
+        try:
+            build = jenkins_job.wait_for_start(trigger_reply)
+        except (TimeoutError, CustomHTTPError) as err:
+            logger.error(err)
+            exit(1)
+        logger.info(f"Build:\n\t{build['url']}")
 
-    if args.wait:
-        pass
+        if args.wait:
+            result = jenkins_job.wait_for_build(build['url'])
+            logger.info(f"Build finished: {result}")
+            if result != "SUCCESS":
+                exit(1)
 
     logger.info("Done")
@@ -1,59 +1,43 @@
 #!/usr/bin/python3
 
-import boto3
+import aws_cache
+import ec2_batch
+import ec2_wait
 import os
 from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+from ec2_records import InstanceRecord
 from AwsRegionsDictionary.RegionsMapping import mapToRegionKey # https://github.com/go-dima/aws-regions-dictionary
 
-
-def get_instance_ids(instances):
-    return ec2client.instances.filter(InstanceIds=[instance['id'] for instance in instances])
-
-
-def power_on(instances):
-    if len(instances) == 0:
-        print(f"Nothing to power on.")
-    else:
-        print(f"Powering on {len(instances)} instances: {[instance['name'] for instance in instances]}")
-        if args.dry_run:
-            dry_power_on(instances)
-        else:
-            run_power_on(instances)
-
-
-def extract_instance_data(instance):
-    return {
-        'id': instance.id,
-        'name': extract_name_tag(instance.tags),
-        'tags': flatten(instance.tags),
-        'ip': instance.public_ip_address,
-        'state': instance.state['Name']
-    }
+ALL_REGIONS = 'all'
+# states start_instances accepts (a no-op for pending/running), the tag:Name wildcard also matches terminated ones
+STARTABLE_STATES = ['pending', 'running', 'stopped']
 
 
-def extract_name_tag(tags):
-    if tags is None:
-        return "UNKNOWN NAME"
-    return [item['Value'] for item in tags if item['Key'] == 'Name'][0]
+def get_instance_ids(instances):
+    return [instance.id for instance in instances]
 
 
-def flatten(tags):
-    flat = {}
-    if tags is not None:
-        for item in tags:
-            flat[item['Key']] = item['Value']
-    return flat
+def power_on(target, instances):
+    print(f"{describe_target(target)}: Powering on {len(instances)} instances: {[instance.name for instance in instances]}")
+    if args.dry_run:
+        dry_power_on(instances)
+        return []
+    return run_power_on(target, instances)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-r', '--region', action='store', default='frankfurt', dest='region', help='Region to describe')
+    parser.add_argument('-r', '--region', action='store', default='frankfurt', dest='region', help=f"Region to describe, '{ALL_REGIONS}' for every region")
     parser.add_argument('-n', '--name', action='store', dest='machineName', help='Machine Tag:Name')
     parser.add_argument('-a', '--async', action='store_true', dest='run_async', default=False, help='Async mode')
     parser.add_argument('-l', '--list', action='store_true', default=False, help='List matching machines')
     parser.add_argument('-d', '--dry-run', action='store_true', dest='dry_run', default=False, help='Perform dry run')
-    parser.add_argument('-p', '--profile', action='store', default='default', help='Profile name to use')
+    parser.add_argument('-p', '--profile', action='store', default='default', help='Profile name to use, comma separated for several')
+    parser.add_argument('--wait-ip', action='store_true', dest='wait_ip', default=False, help='Wait for public ip assignment')
+    parser.add_argument('-t', '--timeout', action='store', type=int, default=ec2_wait.DEFAULT_TIMEOUT, help='Wait timeout in seconds')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=16, help='Max concurrent (profile, region) queries')
     return parser.parse_args()
 
 
@@ -61,43 +45,106 @@ def add_suffix(instances):
     return "s" if len(instances) > 1 else ""
 
 
-def run_power_on(instances):
-    return get_instance_ids(instances).start()
+def run_power_on(target, instances):
+    results = ec2_batch.start_instances(get_ec2client(target).meta.client, get_instance_ids(instances))
+    print(f"{describe_target(target)}: {ec2_batch.describe_results(results)}")
+    return results
 
 
 def dry_power_on(instances):
     print(f"Dry run: Start {len(instances)} instance{add_suffix(instances)}")
 
 
-def get_instances_data():
-    return [extract_instance_data(instance) for instance in ec2client.instances.filter(Filters=filters)]
+def get_targets():
+    """(profile, region) pairs to search"""
+    targets = []
+    for profile in [profile.strip() for profile in args.profile.split(',')]:
+        regions = aws_cache.get_regions(profile) if args.region == ALL_REGIONS else [mapToRegionKey(args.region)]
+        targets.extend((profile, region) for region in regions)
+    return targets
+
+
+def describe_target(target):
+    profile, region = target
+    return f"{profile}/{region}"
+
+
+def get_ec2client(target):
+    profile, region = target
+    return aws_cache.resource('ec2', region, profile=profile)
+
+
+def get_instances_data(target):
+    return [InstanceRecord.from_instance(instance, details=True)
+            for instance in get_ec2client(target).instances.filter(Filters=filters)]
+
+
+def wait_for(target, instance_ids):
+    return ec2_wait.wait_for_instances(get_ec2client(target), instance_ids,
+                                       require_ip=args.wait_ip, timeout=args.timeout)
+
+
+def for_each_target(func, targets):
+    """Runs func(target) concurrently, returns {target: result}, failed targets are reported and skipped"""
+    def run(target):
+        try:
+            return target, func(target)
+        except Exception as ex:
+            print(f"{describe_target(target)}: failed - {type(ex).__name__}: {ex}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(targets)))) as executor:
+        return dict(result for result in executor.map(run, targets) if result is not None)
+
+
+def print_table(found):
+    rows = sorted((instance.name, instance.ip or '', instance.state, describe_target(target))
+                  for target, instances in found.items() for instance in instances)
+    if len(targets) == 1:
+        for name, ip, state, _ in rows:
+            print(f"{name}: {ip} - {state}")
+        return
+    widths = [max(len(row[column]) for row in rows) for column in range(4)]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
 
 
-ec2client = None
 filters = None
+targets = None
 args = None
 
 if __name__ == '__main__':
     args = parse_args()
-    session = boto3.session.Session(profile_name=args.profile)
-    ec2client = session.resource('ec2', region_name=mapToRegionKey(args.region))
-    filters = [dict(Name='tag:Name', Values=[f"*{args.machineName}*"])]
-    instancesData = get_instances_data()
-    for instanceData in instancesData:
-        print(f"{instanceData['name']}: {instanceData['ip']} - {instanceData['state']}")
-
-    if len(instancesData) == 0:
+    filters = [dict(Name='tag:Name', Values=[f"*{args.machineName}*"]),
+               dict(Name='instance-state-name', Values=STARTABLE_STATES)]
+    targets = get_targets()
+    found = {target: instances for target, instances in for_each_target(get_instances_data, targets).items() if instances}
+
+    if len(found) == 0:
         print("No instances found.")
         exit(0)
 
+    print_table(found)
+
     if args.list:
         exit(0)
 
-    power_on(instancesData)
+    started = for_each_target(lambda target: power_on(target, found[target]), list(found))
 
-    if args.run_async or len(instancesData) != 1:
+    if args.run_async or args.dry_run:
         exit(0)
 
-    while get_instances_data()[0]['state'] != 'running':
-        pass
-    print(get_instances_data()[0]['ip'])
+    # instances that failed to start were reported by run_power_on, waiting on them would only time out
+    toWait = {target: [result['id'] for result in results if 'error' not in result]
+              for target, results in started.items()}
+    failedStarts = sum(len(results) for results in started.values()) - sum(len(ids) for ids in toWait.values())
+    waited = for_each_target(lambda target: wait_for(target, toWait[target]),
+                             [target for target, ids in toWait.items() if ids])
+    timedOut = [instanceId for _, pending in waited.values() for instanceId in pending]
+    if timedOut:
+        print(f"Timed out after {args.timeout}s, still waiting for {timedOut}")
+    for ready, _ in waited.values():
+        for instance in ready:
+            print(instance.ip)  # last lines are the ready ips, one per instance, for use in scripts
+    if timedOut or failedStarts or len(started) != len(found) or len(waited) != len([ids for ids in toWait.values() if ids]):
+        exit(1)  # failed targets were already reported
@@ -1,12 +1,20 @@
 #!/usr/bin/python3
 
-import boto3
+import aws_cache
 import json
 import argparse
-import multiprocessing
-from joblib import Parallel, delayed
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from AwsRegionsDictionary.RegionsMapping import mapToRegionKey # https://github.com/go-dima/aws-regions-dictionary
 
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_WAIT_TIMEOUT = 30 * 60
+MIN_INTERVAL = 5
+MAX_INTERVAL = 30
+BACKOFF = 1.5
+TARGET_STATUS = {'start': 'available', 'stop': 'stopped'}
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -21,45 +29,157 @@ def parse_args():
         action='store',
         dest='region',
         help='Region to run on')
+    parser.add_argument(
+        '-a', '--action',
+        action='store',
+        default='start',
+        choices=['start', 'stop'],
+        help='Action to perform (default: start)')
+    parser.add_argument(
+        '-w', '--workers',
+        action='store',
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        dest='max_workers',
+        help='Max concurrent API calls')
+    parser.add_argument(
+        '--wait',
+        action='store_true',
+        default=False,
+        help='Wait for started/stopped clusters to become available/stopped')
+    parser.add_argument(
+        '-t', '--timeout',
+        action='store',
+        type=int,
+        default=DEFAULT_WAIT_TIMEOUT,
+        help='Wait timeout in seconds')
     return parser.parse_args()
 
 
 def handleStart(rdsClient, clusterIdentifier):
-    print(f"\tStarting {clusterIdentifier}")
     rdsClient.start_db_cluster(DBClusterIdentifier=clusterIdentifier)
+    return f"\tStarting {clusterIdentifier}"
 
 
 def handleStop(rdsClient, clusterIdentifier):
-    print(f"\tStopping {clusterIdentifier}")
     rdsClient.stop_db_cluster(DBClusterIdentifier=clusterIdentifier)
+    return f"\tStopping {clusterIdentifier}"
 
 
-def handleRegion(region_name, action):
-    rdsClient = boto3.client('rds', region_name)
+handlers = {
+    ('start', 'stopped'): handleStart,
+    ('stop', 'available'): handleStop,
+}
+
+
+def handleRegion(region_name, event, callsExecutor):
+    """Lists a region's clusters and toggles them concurrently, returns its output lines and result"""
+    rdsClient = aws_cache.client('rds', region_name)
     regionalDBClusters = rdsClient.describe_db_clusters()
     dbClusters = regionalDBClusters['DBClusters']
-    print(f"{region_name}: {len(dbClusters)} rds clusters")
+    output = [f"{region_name}: {len(dbClusters)} rds clusters"]
+    clusters = {}
+    calls = {}
     for cluster in dbClusters:
         clusterStatus = cluster['Status']
         clusterIdentifier = cluster['DBClusterIdentifier']
-        print(f"\t{clusterIdentifier} is {clusterStatus}")
-        if not args.list:
-           if (action == 'start' and clusterStatus == 'stopped'):
-               handleStart(rdsClient, clusterIdentifier)
-           if (action == 'stop' and clusterStatus == 'available'):
-               handleStop(rdsClient, clusterIdentifier)
+        output.append(f"\t{clusterIdentifier} is {clusterStatus}")
+        clusters[clusterIdentifier] = {'status': clusterStatus, 'action': None}
+        handler = handlers.get((event['action'], clusterStatus))
+        if handler and not event.get('list'):
+            calls[callsExecutor.submit(handler, rdsClient, clusterIdentifier)] = clusterIdentifier
+    for call in as_completed(calls):
+        clusterIdentifier = calls[call]
+        try:
+            output.append(call.result())
+            clusters[clusterIdentifier]['action'] = event['action']
+        except Exception as ex:
+            output.append(f"\tFailed to {event['action']} {clusterIdentifier}: {ex}")
+            clusters[clusterIdentifier]['error'] = str(ex)
+    return output, {'status': 'ok', 'clusters': clusters}
 
 
 def lambda_handler(event, context):
+    """event: {'action': 'start'|'stop', 'region'?: name, 'list'?: bool, 'maxWorkers'?: int, 'wait'?: bool, 'timeout'?: seconds}"""
     regionsToHandle = []
-    if args.region:
-        regionsToHandle.append(mapToRegionKey(args.region))
+    if event.get('region'):
+        regionsToHandle.append(mapToRegionKey(event['region']))
     else:
-        regionsResponse = boto3.client('ec2').describe_regions()
-        regionsToHandle.extend([region['RegionName'] for region in regionsResponse['Regions']])
-    num_cores = multiprocessing.cpu_count()
-    Parallel(n_jobs=num_cores)(delayed(handleRegion)(region, event['action']) for region in regionsToHandle)
+        regionsToHandle.extend(aws_cache.get_regions())
+    maxWorkers = max(1, int(event.get('maxWorkers', os.environ.get('MAX_WORKERS', DEFAULT_MAX_WORKERS))))
+
+    summary = {}
+    # regions and start/stop calls get separate pools, so regions waiting on their calls can't starve them
+    with ThreadPoolExecutor(max_workers=maxWorkers) as regionsExecutor, \
+            ThreadPoolExecutor(max_workers=maxWorkers) as callsExecutor:
+        futures = {regionsExecutor.submit(handleRegion, region, event, callsExecutor): region
+                   for region in regionsToHandle}
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                output, summary[region] = future.result()
+            except Exception as ex:
+                output = [f"{region}: failed - {type(ex).__name__}: {ex}"]
+                summary[region] = {'status': 'error', 'error': str(ex)}
+            print("\n".join(output))  # one block per region, so output doesn't interleave
+
+        result = {'action': event['action'], 'regions': summary}
+        if event.get('wait'):
+            touched = {region: [clusterIdentifier for clusterIdentifier, cluster in regionSummary['clusters'].items()
+                                if cluster['action']]
+                       for region, regionSummary in summary.items() if regionSummary['status'] == 'ok'}
+            result['ready'] = wait_for_clusters({region: ids for region, ids in touched.items() if ids},
+                                                TARGET_STATUS[event['action']],
+                                                event.get('timeout', DEFAULT_WAIT_TIMEOUT), regionsExecutor)
+    return result
+
+
+def fetch_statuses(region_name, clusterIdentifiers):
+    """One describe_db_clusters call for all of a region's clusters"""
+    rdsClient = aws_cache.client('rds', region_name)
+    response = rdsClient.describe_db_clusters(Filters=[{'Name': 'db-cluster-id', 'Values': clusterIdentifiers}])
+    return {cluster['DBClusterIdentifier']: cluster['Status'] for cluster in response['DBClusters']}
+
+
+def wait_for_clusters(clusters, targetStatus, timeout, executor):
+    """Polls {region: [cluster ids]} until all reach `targetStatus`
+
+    Every tick queries each region with pending clusters once, concurrently.
+    Returns {'region/cluster': seconds to ready, or None if timed out}.
+    """
+    start = time.monotonic()
+    pending = {region: list(clusterIdentifiers) for region, clusterIdentifiers in clusters.items()}
+    ready = {f"{region}/{clusterIdentifier}": None
+             for region, clusterIdentifiers in clusters.items() for clusterIdentifier in clusterIdentifiers}
+    interval = MIN_INTERVAL
+    print(f"Waiting for {len(ready)} clusters to become {targetStatus}")
+    while pending and time.monotonic() - start < timeout:
+        time.sleep(interval)
+        futures = {executor.submit(fetch_statuses, region, clusterIdentifiers): region
+                   for region, clusterIdentifiers in pending.items()}
+        changed = False
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                statuses = future.result()
+            except Exception as ex:
+                print(f"{region}: failed to poll - {type(ex).__name__}: {ex}")
+                continue
+            for clusterIdentifier, status in statuses.items():
+                if status == targetStatus and clusterIdentifier in pending[region]:
+                    elapsed = time.monotonic() - start
+                    ready[f"{region}/{clusterIdentifier}"] = round(elapsed)
+                    pending[region].remove(clusterIdentifier)
+                    changed = True
+                    print(f"\t{region}/{clusterIdentifier} is {status} after {elapsed:.0f}s")
+        pending = {region: clusterIdentifiers for region, clusterIdentifiers in pending.items() if clusterIdentifiers}
+        interval = MIN_INTERVAL if changed else min(MAX_INTERVAL, interval * BACKOFF)
+    if pending:
+        print(f"Timed out after {timeout}s, still waiting for {[key for key, elapsed in ready.items() if elapsed is None]}")
+    return ready
 
 
-args = parse_args()
-lambda_handler({'action': 'start'}, '')
+if __name__ == '__main__':
+    args = parse_args()
+    lambda_handler({'action': args.action, 'region': args.region, 'list': args.list, 'maxWorkers': args.max_workers,
+                    'wait': args.wait, 'timeout': args.timeout}, '')
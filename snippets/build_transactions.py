@@ -1,13 +1,21 @@
 import re
-from typing import Dict
+import argparse
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
 import pandas as pd
 import json
-from datetime import datetime
-from functools import reduce
-from copy import deepcopy
+import transaction_rollups
+
+KEY_COLUMNS = ['account', 'date', 'reference', 'amount']
+TEXT_COLUMNS = ['תיאור', 'תאור', 'קטגוריה']
 
 
 class Entry:
+    """A single transaction, either parsed from a raw sheet row or a view over a normalized one"""
+
     def __init__(self, account_name, data: Dict) -> None:
         self.account = account_name
         self.date = data['תאריך'].to_pydatetime().strftime("%d-%m-%Y")
@@ -20,41 +28,307 @@ class Entry:
         income = float(data['זכות'])
         expense = float(data['חובה'])
         self.amount: float = income - expense
-        self.balance = float(re.sub(r'[^1-9-.]', '', str(data['יתרה'])))
+        self.balance = float(re.sub(r'[^0-9-.]', '', str(data['יתרה'])))
 
+    @classmethod
+    def view(cls, record: Dict):
+        """Entry over a normalize()/formatted() record, no parsing, `date` is a "%d-%m-%Y" string as in __init__"""
+        entry = cls.__new__(cls)
+        entry.__dict__.update(record)
+        if not isinstance(entry.date, str):
+            entry.date = entry.date.strftime("%d-%m-%Y")
+        return entry
 
-excel_path = "./Flow.xlsx"
 
-sheets = pd.read_excel(excel_path, sheet_name=[0, 2])
-sheets["Dima"] = sheets[0]
-sheets["Anna"] = sheets[2]
+num_of_columns = 9
+default_accounts = [
+    {"name": "Dima", "workbook": "./Flow.xlsx", "sheet": 0},
+    {"name": "Anna", "workbook": "./Flow.xlsx", "sheet": 2},
+]
 
 
-def as_key(date_str: str):
-    return datetime.strptime(date_str, '%d-%m-%Y').strftime("%y%m%d")
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--incremental', dest='incremental',
+        action='store_true',
+        help="Import only rows missing from the store, export just those")
+    parser.add_argument(
+        '--store', dest='store',
+        action='store', default="./transactions.db",
+        help="Sqlite store used by --incremental (default: ./transactions.db)")
+    parser.add_argument(
+        '--lookback-days', dest='lookback_days',
+        action='store', type=int,
+        help="With --incremental, only check rows dated up to this many days before the last import "
+             "against the store (default: check every row, so late-posted rows are never missed)")
+    parser.add_argument(
+        '--no-cache', dest='use_cache',
+        action='store_false',
+        help="Always parse the workbook, ignoring its parquet sidecar")
+    parser.add_argument(
+        '-f', '--format', dest='format',
+        action='store', choices=list(writers), default='json',
+        help="Output format (default: json)")
+    parser.add_argument(
+        '-a', '--accounts', dest='accounts',
+        action='store',
+        help='Json list of {"name", "workbook", "sheet"} account mappings (default: Dima/Anna in ./Flow.xlsx)')
+    parser.add_argument(
+        '-w', '--workers', dest='workers',
+        action='store', type=int, default=os.cpu_count(),
+        help="Workbooks parsed in parallel (default: cpu count)")
+    return parser.parse_args()
 
 
-def min_date(f: str, s: str):
-    return f if f < s else s
+def normalize(account_name, sheet: pd.DataFrame, since=None) -> pd.DataFrame:
+    """Column-wise equivalent of building an Entry per row, columns follow Entry's attributes
 
+    With `since` (the start of the --lookback-days window), rows dated before it are dropped
+    before anything else is parsed.
+    """
+    df = sheet.iloc[:, :num_of_columns]
+    df.columns = [str.strip(col) for col in df.columns]
+    # text columns are filled with "" so each has a single type (parquet needs one per column)
+    df = df.fillna({col: "" for col in TEXT_COLUMNS if col in df}).fillna(0)
+    print(list(df.columns))
+    dates = pd.to_datetime(df['תאריך']).dt.normalize()  # the day, as stored and as Entry formats it
+    if since is not None:
+        df, dates = df[dates >= since], dates[dates >= since]
+    description = df['תיאור'] if 'תיאור' in df else df.get('תאור', pd.Series("", index=df.index))
+    return pd.DataFrame({
+        'account': account_name,
+        'date': dates,  # formatted on output, kept as datetime for sorting and bounds
+        'description': description.astype(str),
+        'category': df['קטגוריה'].where(df['קטגוריה'] != 0, "").astype(str),
+        'reference': pd.to_numeric(df['אסמכתא'], errors='coerce').fillna(0).astype(int),
+        'amount': df['זכות'].astype(float) - df['חובה'].astype(float),
+        'balance': df['יתרה'].astype(str).str.replace(r'[^0-9-.]', '', regex=True).astype(float),
+    }, index=df.index)
 
-entries = []
-num_of_columns = 9
 
-for account in ["Dima", "Anna"]:
-    df = sheets[account].fillna(0)
-    df_columns = [str.strip(col) for col in df.columns[:num_of_columns]]
-    print(df_columns)
-    transactions_data = map(lambda entry_value: zip(df_columns, entry_value[:num_of_columns]), df.values.tolist())
-    account_entries = [Entry(account, dict(data)) for data in transactions_data]
-    print(f"account {account}: found {len(account_entries)} entries")
-    entries.extend(account_entries)
-
-date_keys = map(lambda e: as_key(e.date), entries)
-min_reduce = reduce(min, deepcopy(date_keys))
-max_reduce = reduce(max, deepcopy(date_keys))
-
-filename = f"transactions_{min_reduce}_{max_reduce}.json"
-with open(filename, "w", encoding='utf-8') as file:
-    json.dump([e.__dict__ for e in entries], file, ensure_ascii=False)
-print(filename)
+def formatted(transactions: pd.DataFrame) -> pd.DataFrame:
+    return transactions.assign(date=transactions['date'].dt.strftime("%d-%m-%Y"))
+
+
+def as_entries(transactions: pd.DataFrame):
+    """Lazily yields Entry views over the formatted rows"""
+    rows = formatted(transactions)
+    columns = list(rows.columns)
+    for values in rows.itertuples(index=False, name=None):
+        yield Entry.view(dict(zip(columns, values)))
+
+
+def write_json(transactions: pd.DataFrame, filename):
+    """Single json array, serialized by pandas' C encoder without building per row dicts"""
+    formatted(transactions).to_json(filename, orient='records', force_ascii=False, double_precision=15)
+
+
+def write_ndjson(transactions: pd.DataFrame, filename):
+    """One json object per line, written row by row"""
+    rows = formatted(transactions)
+    columns = list(rows.columns)
+    with open(filename, "w", encoding='utf-8') as file:
+        for values in rows.itertuples(index=False, name=None):
+            file.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False, default=lambda value: value.item()))
+            file.write("\n")
+
+
+def write_csv(transactions: pd.DataFrame, filename):
+    formatted(transactions).to_csv(filename, index=False, encoding='utf-8')
+
+
+def write_parquet(transactions: pd.DataFrame, filename):
+    transactions.to_parquet(filename, index=False)  # keeps the native datetime column
+
+
+writers = {
+    'json': write_json,
+    'ndjson': write_ndjson,
+    'csv': write_csv,
+    'parquet': write_parquet,
+}
+
+
+def open_store(path):
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            account TEXT, date TEXT, description TEXT, category TEXT,
+            reference INTEGER, amount REAL, balance REAL,
+            UNIQUE (account, date, reference, amount));
+        CREATE TABLE IF NOT EXISTS bounds (account TEXT PRIMARY KEY, min_date TEXT, max_date TEXT);
+    """)
+    transaction_rollups.create_tables(connection)
+    return connection
+
+
+def lookback_start(connection, account_name, lookback_days):
+    """First day to check against the store: `lookback_days` before the last import, None to check all rows"""
+    if lookback_days is None:
+        return None
+    bounds = connection.execute("SELECT max_date FROM bounds WHERE account = ?", (account_name,)).fetchone()
+    return pd.Timestamp(bounds[0]) - pd.Timedelta(days=lookback_days) if bounds else None
+
+
+def import_new(connection, account_name, candidates: pd.DataFrame) -> pd.DataFrame:
+    """Appends the account's rows missing from the store, returns the rows actually inserted
+
+    Every candidate is checked against the (account, date, reference, amount) index,
+    so rows posted late with an earlier date are still picked up.
+    """
+    candidates = candidates.drop_duplicates(subset=KEY_COLUMNS)
+    if len(candidates) > 0:
+        known = pd.read_sql_query(
+            "SELECT account, date, reference, amount FROM transactions WHERE account = ? AND date BETWEEN ? AND ?",
+            connection, params=(account_name, candidates['date'].min().strftime("%Y-%m-%d"),
+                                candidates['date'].max().strftime("%Y-%m-%d")), parse_dates=['date'])
+        merged = candidates.merge(known, on=KEY_COLUMNS, how='left', indicator=True)
+        candidates = candidates[(merged['_merge'] == 'left_only').to_numpy()]
+    if len(candidates) == 0:
+        return candidates
+
+    stored = candidates.assign(date=candidates['date'].dt.strftime("%Y-%m-%d"))
+    rows = stored[['account', 'date', 'description', 'category', 'reference', 'amount', 'balance']]
+    with connection:
+        # per row, so rows the UNIQUE index ignores are left out of the result, bounds and rollups
+        inserted = [connection.execute("INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       row).rowcount == 1
+                    for row in rows.astype(object).itertuples(index=False, name=None)]
+        candidates, stored = candidates[inserted], stored[inserted]
+        if len(candidates) == 0:
+            return candidates
+        new_min, new_max = stored['date'].min(), stored['date'].max()
+        connection.execute("""
+            INSERT INTO bounds VALUES (?, ?, ?)
+            ON CONFLICT (account) DO UPDATE SET min_date = min(min_date, excluded.min_date),
+                                                max_date = max(max_date, excluded.max_date)
+        """, (account_name, new_min, new_max))
+        transaction_rollups.update(connection, candidates)
+    return candidates
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sidecar_path(path, name):
+    return os.path.join(f"{path}.cache", name)
+
+
+def load_sidecar(path, sheet_index):
+    """Cached sheet if the workbook didn't change since it was written, else None
+
+    Size and mtime are checked first, the content hash only when they differ (e.g. after a copy).
+    """
+    meta_path = sidecar_path(path, f"sheet_{sheet_index}.json")
+    try:
+        with open(meta_path) as file:
+            meta = json.load(file)
+        stat = os.stat(path)
+        if (meta['size'], meta['mtime']) != (stat.st_size, stat.st_mtime):
+            if meta['size'] != stat.st_size or meta['sha256'] != file_hash(path):
+                return None
+            meta['mtime'] = stat.st_mtime
+            with open(meta_path, "w") as file:
+                json.dump(meta, file)
+        return pd.read_parquet(sidecar_path(path, f"sheet_{sheet_index}.parquet"))
+    except (OSError, ValueError, KeyError, ImportError):
+        return None
+
+
+def store_sidecar(path, sheet_index, sheet: pd.DataFrame):
+    """One parquet + meta pair per sheet, so accounts sharing a workbook don't race on it"""
+    try:
+        os.makedirs(f"{path}.cache", exist_ok=True)
+        # parquet needs one type per column, mixed object columns are stored as text (nulls kept)
+        text_columns = {col: sheet[col].where(sheet[col].isna(), sheet[col].astype(str))
+                        for col in sheet.columns if sheet[col].dtype == object}
+        sheet.assign(**text_columns).to_parquet(sidecar_path(path, f"sheet_{sheet_index}.parquet"))
+        stat = os.stat(path)
+        meta = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash(path)}
+        with open(sidecar_path(path, f"sheet_{sheet_index}.json"), "w") as file:
+            json.dump(meta, file)
+    except (OSError, ValueError, ImportError) as err:
+        print(f"Not caching {path}: {err}")
+
+
+def read_sheets(path, sheet_indexes, use_cache=True):
+    """{sheet index: needed columns}, from the parquet sidecars when the workbook is unchanged
+
+    Sheets without a valid sidecar are parsed together, so the workbook is opened at most once.
+    """
+    sheets = {index: load_sidecar(path, index) if use_cache else None for index in sheet_indexes}
+    missing = [index for index, sheet in sheets.items() if sheet is None]
+    if missing:
+        parsed = pd.read_excel(path, sheet_name=missing, usecols=range(num_of_columns))
+        for index in missing:
+            sheets[index] = parsed[index]
+            if use_cache:
+                store_sidecar(path, index, parsed[index])
+    return sheets
+
+
+def load_workbook(path, accounts: List[Dict], use_cache=True, since=None) -> List[pd.DataFrame]:
+    """Reads and normalizes the accounts of one workbook, runs in a worker process"""
+    sheets = read_sheets(path, list(dict.fromkeys(account['sheet'] for account in accounts)), use_cache)
+    return [normalize(account['name'], sheets[account['sheet']], account_since)
+            for account, account_since in zip(accounts, since or [None] * len(accounts))]
+
+
+def by_workbook(accounts: List[Dict]):
+    """{workbook path: [account index, ...]}, in the accounts' order"""
+    groups = {}
+    for position, account in enumerate(accounts):
+        groups.setdefault(account['workbook'], []).append(position)
+    return groups
+
+
+def read_accounts(path):
+    if not path:
+        return default_accounts
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    accounts = read_accounts(args.accounts)
+    connection = open_store(args.store) if args.incremental else None
+    since = [lookback_start(connection, account['name'], args.lookback_days) if args.incremental else None
+             for account in accounts]
+
+    workbooks = by_workbook(accounts)
+    loaded = [None] * len(accounts)
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers or 1, len(workbooks)))) as executor:
+        futures = {executor.submit(load_workbook, path, [accounts[position] for position in positions],
+                                   args.use_cache, [since[position] for position in positions]): positions
+                   for path, positions in workbooks.items()}
+        for future, positions in futures.items():
+            for position, account_transactions in zip(positions, future.result()):
+                loaded[position] = account_transactions
+
+    frames = []
+    for account, account_transactions in zip(accounts, loaded):
+        if args.incremental:
+            account_transactions = import_new(connection, account['name'], account_transactions)
+            print(f"account {account['name']}: imported {len(account_transactions)} new entries")
+        else:
+            print(f"account {account['name']}: found {len(account_transactions)} entries")
+        frames.append(account_transactions)
+    transactions = pd.concat(frames, ignore_index=True).sort_values('date', kind='stable', ignore_index=True)
+
+    if len(transactions) == 0:
+        print("Nothing new to export")
+        exit(0)
+
+    min_key = transactions['date'].min().strftime("%y%m%d")
+    max_key = transactions['date'].max().strftime("%y%m%d")
+
+    filename = f"transactions_{min_key}_{max_key}.{args.format}"
+    writers[args.format](transactions, filename)
+    print(filename)
@@ -0,0 +1,112 @@
+"""Monthly rollups over the build_transactions sqlite store
+
+Per account x month x category sums and counts, and per account x month net,
+running total and closing balance. Updated incrementally with every import, so
+reports query the rollups instead of scanning all transactions.
+Months are 'YYYY-MM' strings, ranges are inclusive.
+"""
+
+import sqlite3
+import pandas as pd
+
+
+def create_tables(connection: sqlite3.Connection):
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS rollups (
+            account TEXT, month TEXT, category TEXT, total REAL, count INTEGER,
+            PRIMARY KEY (account, month, category));
+        CREATE TABLE IF NOT EXISTS monthly (
+            account TEXT, month TEXT, net REAL, running REAL, last_date TEXT, closing_balance REAL,
+            PRIMARY KEY (account, month));
+    """)
+    if connection.execute("SELECT 1 FROM monthly LIMIT 1").fetchone() is None:
+        rebuild(connection)  # store filled before rollups existed
+
+
+def rebuild(connection: sqlite3.Connection):
+    """Recomputes all rollups from the stored transactions"""
+    transactions = pd.read_sql_query("SELECT account, date, category, amount, balance FROM transactions",
+                                     connection, parse_dates=['date'])
+    with connection:
+        connection.execute("DELETE FROM rollups")
+        connection.execute("DELETE FROM monthly")
+        update(connection, transactions)
+
+
+def update(connection: sqlite3.Connection, transactions: pd.DataFrame):
+    """Adds newly imported transactions (normalized frame with a datetime `date`) to the rollups
+
+    Pass only the rows actually inserted, rows ignored by the store's UNIQUE index would be counted twice.
+    Runs in the caller's sqlite transaction, so rollups and rows are committed together.
+    """
+    if len(transactions) == 0:
+        return
+    rows = transactions.assign(month=transactions['date'].dt.strftime("%Y-%m"),
+                               date=transactions['date'].dt.strftime("%Y-%m-%d"))
+
+    by_category = rows.groupby(['account', 'month', 'category'], sort=False)['amount'].agg(['sum', 'count'])
+    connection.executemany("""
+        INSERT INTO rollups VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (account, month, category) DO UPDATE SET total = total + excluded.total,
+                                                             count = count + excluded.count
+    """, by_category.reset_index().astype(object).itertuples(index=False, name=None))
+
+    by_month = rows.groupby(['account', 'month'], sort=False)['amount'].sum().rename('net')
+    last_rows = rows.sort_values('date', kind='stable').groupby(['account', 'month'], sort=False).tail(1)
+    closing = last_rows.set_index(['account', 'month'])[['date', 'balance']]
+    months = pd.concat([by_month, closing], axis=1).reset_index()
+    connection.executemany("""
+        INSERT INTO monthly VALUES (?, ?, ?, 0, ?, ?)
+        ON CONFLICT (account, month) DO UPDATE SET
+            net = net + excluded.net,
+            closing_balance = CASE WHEN excluded.last_date >= last_date THEN excluded.closing_balance
+                                   ELSE closing_balance END,
+            last_date = max(last_date, excluded.last_date)
+    """, months[['account', 'month', 'net', 'date', 'balance']].astype(object).itertuples(index=False, name=None))
+
+    # running totals only change from the earliest touched month on
+    for account, first_month in months.groupby('account')['month'].min().items():
+        connection.execute("""
+            UPDATE monthly SET running = (SELECT SUM(previous.net) FROM monthly previous
+                                          WHERE previous.account = monthly.account AND previous.month <= monthly.month)
+            WHERE account = ? AND month >= ?
+        """, (account, first_month))
+
+
+def _where(account=None, start=None, end=None, category=None):
+    clauses, params = [], []
+    for clause, value in [("account = ?", account), ("month >= ?", start), ("month <= ?", end),
+                          ("category = ?", category)]:
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def range_total(connection: sqlite3.Connection, start=None, end=None, account=None, category=None):
+    """(sum, count) of amounts in the month range"""
+    where, params = _where(account, start, end, category)
+    total, count = connection.execute(f"SELECT SUM(total), SUM(count) FROM rollups{where}", params).fetchone()
+    return total or 0.0, count or 0
+
+
+def category_totals(connection: sqlite3.Connection, start=None, end=None, account=None):
+    """{category: (sum, count)} in the month range"""
+    where, params = _where(account, start, end)
+    rows = connection.execute(
+        f"SELECT category, SUM(total), SUM(count) FROM rollups{where} GROUP BY category", params)
+    return {category: (total, count) for category, total, count in rows}
+
+
+def monthly_totals(connection: sqlite3.Connection, start=None, end=None, account=None, category=None):
+    """Frame of account, month, category, total, count in the month range"""
+    where, params = _where(account, start, end, category)
+    return pd.read_sql_query(f"SELECT * FROM rollups{where} ORDER BY account, month, category",
+                             connection, params=params)
+
+
+def balances(connection: sqlite3.Connection, account, start=None, end=None):
+    """Frame of month, net, running total and closing balance of an account"""
+    where, params = _where(account, start, end)
+    return pd.read_sql_query(f"SELECT month, net, running, closing_balance FROM monthly{where} ORDER BY month",
+                             connection, params=params)